@@ -4,7 +4,18 @@ import numpy as np
 import json
 from datasetmanager import *
 
+try:
+    import polars as pl
+    # GroupBy.len(name=...) needs polars 1.0 or newer
+    _HAS_POLARS = int(pl.__version__.split('.')[0]) >= 1
+except ImportError:
+    _HAS_POLARS = False
+
 class CovidData:
+    LOCATION_COLUMNS = ('County', 'Province/State', 'Country/Region')
+    COORDINATE_COLUMNS = ('Lat', 'Long')
+    ROUTE_LOCATION_COLUMNS = ('DepartCounty', 'DepartProvince/State', 'DepartCountry/Region',
+                              'ArrivalCounty', 'ArrivalProvince/State', 'ArrivalCountry/Region')
 
     def __init__(self, routes_locations = 'dataset/airport_routes.csv',
                  border_closures_csv='dataset/border_closures.csv',
@@ -21,23 +32,204 @@ class CovidData:
 
             thread_num:       the number of threads to use when running
                               download_route_dataset.py
+
+        The routes dataset is only loaded (and downloaded if it is missing)
+        the first time it is needed, so using just the COVID data doesn't wait
+        on the airport and routes datasets.
         """
         self.border_closures_csv = border_closures_csv
         self.border_closures_json = border_closures_json
         self.eu_countries_csv = eu_countries_csv
+        self.routes_locations = routes_locations
+        self.thread_num = thread_num
         covid_manager = CovidManager()
         datasets = covid_manager.getDatasets()
         self.confirmed_df = datasets['full']['confirmed']
         self.deaths_df = datasets['full']['deaths']
         # Important Note! Recovered can only be used for global data!
         self.recovered_df = datasets['covid_recovered']
-        airport_manager = AirportToLocation(datasets['full']['confirmed'])
+        self._routes_df = None
+        self._routes_filled_df = None
+        self._routes_codes_pl = None
+
+        # The dataframes are never mutated, so fill the missing values and
+        # downcast once here rather than copying and filling on every call.
+        # The locations are kept in a narrow dataframe and the case counts in
+        # a single (locations, dates) array, so the sums run over one block.
+        # The dates are the same on every call, so only find them once.
+        # Every counts array uses the confirmed dates, since recovered can have
+        # more recent dates than the full confirmed and deaths datasets.
+        self._dates = self.confirmed_df.columns[5:].to_list()
+        self._date_positions = {date: position for position, date in enumerate(self._dates)}
+        self._confirmed_locations, self._confirmed_counts = self._splitCounts(self._fillMissing(self.confirmed_df))
+        self._deaths_locations, self._deaths_counts = self._splitCounts(self._fillMissing(self.deaths_df))
+        self._recovered_locations, self._recovered_counts = self._splitCounts(self._fillMissing(self.recovered_df))
+        self._deaths_match_confirmed = self._confirmed_locations.equals(self._deaths_locations)
+        # Counts sorted by country, so each country is a contiguous block
+        self._country_blocks = {
+            'confirmed' : self._sortByCountry(self._confirmed_locations, self._confirmed_counts),
+            'deaths'    : self._sortByCountry(self._deaths_locations, self._deaths_counts),
+            'recovered' : self._sortByCountry(self._recovered_locations, self._recovered_counts)
+        }
+        # Weighted edges already computed, keyed by (bin_region_column, country)
+        self._routes_cache = {}
+
+    def _downloadRoutes(self):
+        """
+        Creates the routes dataset with download_route_dataset.py if it
+        doesn't exist yet.
+        """
+        if os.path.isfile(self.routes_locations): return
+
+        airport_manager = AirportToLocation(self.confirmed_df)
         airport_manager.getDataset()
+        subprocess.run(['python3', 'download_route_dataset.py', '-t', str(self.thread_num)], capture_output=True)
+
+    @property
+    def routes_df(self):
+        if self._routes_df is None:
+            self._downloadRoutes()
+            # Parse the location columns straight into categoricals rather than
+            # inferring object columns and converting them afterwards
+            self._routes_df = pd.read_csv(self.routes_locations,
+                                          dtype={column: 'category' for column in CovidData.ROUTE_LOCATION_COLUMNS})
+        return self._routes_df
+
+    @property
+    def _routes_filled(self):
+        if self._routes_filled_df is None:
+            self._routes_filled_df = self._fillMissingRoutes(self.routes_df)
+        return self._routes_filled_df
+
+    def _fillMissing(self, covid_df):
+        """
+        Fills the missing location names with "none" and the missing numeric
+        values with 0, so the date columns keep their numeric dtype.
+
+        The case counts are downcast to int32 and Lat and Long to float32 to
+        halve the memory scanned when summing over the date columns. The
+        location names are stored as categoricals to speed up grouping.
+        """
+        fill_values = {}
+        dtypes = {}
+        for column in covid_df.columns:
+            if column in CovidData.LOCATION_COLUMNS:
+                fill_values[column] = "none"
+                dtypes[column] = 'category'
+            else:
+                fill_values[column] = 0
+                dtypes[column] = np.float32 if column in CovidData.COORDINATE_COLUMNS else np.int32
+        return covid_df.fillna(fill_values).astype(dtypes)
+
+    def _splitCounts(self, covid_df):
+        """
+        Splits a filled COVID dataframe into a dataframe of the locations and
+        an int32 array of the case counts with a column for each of the
+        confirmed dates, in the same order.
+
+        The array is stored column-major so each date is contiguous, which is
+        the order the grouped sums read it in.
+        """
+        location_columns = [column for column in covid_df.columns
+                            if column in CovidData.LOCATION_COLUMNS + CovidData.COORDINATE_COLUMNS]
+        counts = np.asfortranarray(covid_df[self._dates].to_numpy(dtype=np.int32))
+        return covid_df[location_columns], counts
+
+    def _sortByCountry(self, locations, counts):
+        """
+        Sorts the case counts by country so the country totals can be summed
+        with a single np.add.reduceat instead of a hash based groupby.
+
+        returns:
+            The sorted counts, the row each country starts at and a dataframe
+            of each country with its mean Lat and Long.
+        """
+        countries = locations['Country/Region']
+        country_codes = countries.cat.codes.to_numpy()
+        order = np.argsort(country_codes, kind='stable')
+        present_codes, group_starts = np.unique(country_codes[order], return_index=True)
+
+        coordinates = locations[['Lat', 'Long']].to_numpy(dtype=np.float64)[order]
+        group_sizes = np.diff(np.append(group_starts, len(order)))
+        means = np.add.reduceat(coordinates, group_starts, axis=0) / group_sizes[:, np.newaxis]
+        location_df = pd.DataFrame({'Country/Region' : countries.cat.categories[present_codes],
+                                    'Lat'            : means[:, 0].astype(np.float32),
+                                    'Long'           : means[:, 1].astype(np.float32)})
+
+        return np.asfortranarray(counts[order]), group_starts, location_df
+
+    def _fillMissingRoutes(self, routes_df):
+        """
+        Fills the missing values of the routes dataset with "none". The
+        location columns stay categorical, since grouping on categorical codes
+        avoids hashing every location string.
+        """
+        other_columns = [column for column in routes_df.columns if column not in CovidData.ROUTE_LOCATION_COLUMNS]
+        filled_df = routes_df.fillna({column: "none" for column in other_columns})
+        for column in CovidData.ROUTE_LOCATION_COLUMNS:
+            locations = routes_df[column]
+            if "none" not in locations.cat.categories:
+                locations = locations.cat.add_categories("none")
+            filled_df[column] = locations.fillna("none")
+        return filled_df
+
+    def _sharesConfirmedRows(self, data_type):
+        """
+        Returns whether the data type has the same locations in the same order
+        as confirmed, so its country mask and grouping can be reused.
+        """
+        return data_type == 'confirmed' or (data_type == 'deaths' and self._deaths_match_confirmed)
 
-        if not os.path.isfile(routes_locations):
-            subprocess.run(['python3', 'download_route_dataset.py', '-t', str(thread_num)], capture_output=True)
+    def _groupLocations(self, locations, group_columns):
+        """
+        Groups the locations dataframe by group_columns.
 
-        self.routes_df = pd.read_csv(routes_locations)
+        returns:
+            The group code of every row and a dataframe of each group with its
+            mean Lat and Long.
+        """
+        grouped_df = locations.groupby(group_columns, as_index=False, observed=True)
+        group_codes = grouped_df.ngroup().to_numpy()
+        # Named aggregation gives flat columns, so there is no index to reset
+        location_df = grouped_df.agg(Lat=('Lat', 'mean'), Long=('Long', 'mean'))
+        return group_codes, location_df
+
+    def _sumGroups(self, group_codes, values, num_groups):
+        """
+        Sums the rows of values into num_groups rows based on group_codes.
+        """
+        if values.shape[1] == 1:
+            # A single date only needs one counting pass
+            sums = np.bincount(group_codes, weights=values[:, 0], minlength=num_groups)
+            return sums.astype(np.int64).reshape(-1, 1)
+        # Grouping on the integer codes skips hashing the location names again
+        return pd.DataFrame(values).groupby(group_codes).sum().to_numpy().astype(np.int64)
+
+    def _sortGroups(self, df, group_columns):
+        """
+        Sorts grouped rows by their location names. Older pandas versions
+        ignore sort when grouping categoricals with observed=True, so the rows
+        are sorted here to keep the same order as grouping on strings.
+        """
+        return df.sort_values(group_columns, ignore_index=True)
+
+    def _decategorize(self, df):
+        """
+        Converts categorical columns back to plain string columns so callers
+        can keep using string operations on the returned dataframes.
+        """
+        categorical_columns = df.select_dtypes(include='category').columns
+        return df.astype({column: object for column in categorical_columns})
+
+    def _categoryMask(self, column, value):
+        """
+        Returns a boolean array of the rows of the categorical column equal to
+        value, comparing the integer category codes instead of the strings.
+        """
+        categories = column.cat.categories
+        if value not in categories:
+            return np.zeros(len(column), dtype=bool)
+        return column.cat.codes.to_numpy() == categories.get_loc(value)
 
     def createBorderDataset(self):
         border_closure_df = pd.read_csv(self.border_closures_csv, delimiter=':').fillna('none')
@@ -136,31 +328,77 @@ class CovidData:
         returns:
             A dataframe specifying the number of routes between locations
             specified by the parameters.
+            The dataframe is cached and shared between calls, so copy it
+            before modifying it.
         """
-        new_routes_df = self.routes_df.copy(deep=True).fillna("none")
-
-        if not country == None:
-            new_routes_df = new_routes_df.loc[(new_routes_df['DepartCountry/Region'] == country) & (new_routes_df['ArrivalCountry/Region'] == country)]
+        assert (bin_region_column == 'county') or (bin_region_column == 'state') or (bin_region_column == 'country'), "Invalid region parsed to bin_region_column! Needs to be county, state or country"
 
-        new_routes_df['NumberOfRoutes'] = 1
-        agg_dict = {'NumberOfRoutes' : ['sum']}
-        new_column = ['NumberOfRoutes']
+        cache_key = (bin_region_column, country)
+        if cache_key in self._routes_cache:
+            return self._routes_cache[cache_key]
 
         if bin_region_column == 'county':
-            return new_routes_df.groupby([ 'DepartCounty',
-                                           'DepartProvince/State',
-                                           'DepartCountry/Region',
-                                           'ArrivalCounty',
-                                           'ArrivalProvince/State',
-                                           'ArrivalCountry/Region'])['NumberOfRoutes'].sum().reset_index()
+            group_columns = [ 'DepartCounty',
+                              'DepartProvince/State',
+                              'DepartCountry/Region',
+                              'ArrivalCounty',
+                              'ArrivalProvince/State',
+                              'ArrivalCountry/Region']
         if bin_region_column == 'state':
-            return new_routes_df.groupby([ 'DepartProvince/State',
-                                           'DepartCountry/Region',
-                                           'ArrivalProvince/State',
-                                           'ArrivalCountry/Region'])['NumberOfRoutes'].sum().reset_index()
+            group_columns = [ 'DepartProvince/State',
+                              'DepartCountry/Region',
+                              'ArrivalProvince/State',
+                              'ArrivalCountry/Region']
         if bin_region_column == 'country':
-            return new_routes_df.groupby([ 'DepartCountry/Region',
-                                           'ArrivalCountry/Region'])['NumberOfRoutes'].sum().reset_index()
+            group_columns = [ 'DepartCountry/Region',
+                              'ArrivalCountry/Region']
+
+        if _HAS_POLARS:
+            routes = self._countRoutesPolars(group_columns, country)
+        else:
+            routes = self._countRoutesPandas(group_columns, country)
+
+        routes = self._sortGroups(routes, group_columns)
+        self._routes_cache[cache_key] = routes
+        return routes
+
+    def _countRoutesPandas(self, group_columns, country):
+        """
+        Counts the routes by grouping the categorical routes dataframe.
+        """
+        new_routes_df = self._routes_filled
+
+        if not country == None:
+            within_country = (self._categoryMask(new_routes_df['DepartCountry/Region'], country) &
+                              self._categoryMask(new_routes_df['ArrivalCountry/Region'], country))
+            new_routes_df = new_routes_df.iloc[within_country]
+
+        # Each row is a single route, so the number of routes is the group size
+        routes = new_routes_df.groupby(group_columns, observed=True).size().reset_index(name='NumberOfRoutes')
+        return self._decategorize(routes)
+
+    def _countRoutesPolars(self, group_columns, country):
+        """
+        Counts the routes with a multithreaded polars group by over the
+        category codes of the filled routes dataframe. The missing values,
+        country filter and location names are the same as the pandas path.
+        """
+        routes_df = self._routes_filled
+        if self._routes_codes_pl is None:
+            self._routes_codes_pl = pl.DataFrame({column: routes_df[column].cat.codes.to_numpy()
+                                                  for column in CovidData.ROUTE_LOCATION_COLUMNS})
+        routes_codes = self._routes_codes_pl
+
+        if not country == None:
+            within_country = (self._categoryMask(routes_df['DepartCountry/Region'], country) &
+                              self._categoryMask(routes_df['ArrivalCountry/Region'], country))
+            routes_codes = routes_codes.filter(pl.Series(within_country))
+
+        counts = routes_codes.group_by(group_columns).len(name='NumberOfRoutes')
+        routes = pd.DataFrame({column: routes_df[column].cat.categories[counts[column].to_numpy()]
+                               for column in group_columns})
+        routes['NumberOfRoutes'] = counts['NumberOfRoutes'].to_numpy().astype(np.int64)
+        return routes
 
     def getData(self, bin_region_column='county', country=None, specific_date=None):
         """
@@ -195,54 +433,78 @@ class CovidData:
             Returns a dictionary stores the COVID data as dataframes based on
             the parameters and a dataframe storing the routes between locations
             in the COVID dataframes.
+            The dataframes may be shared with this object, so copy them before
+            modifying them.
         """
         assert (bin_region_column == 'county') or (bin_region_column == 'state') or (bin_region_column == 'country'), "Invalid region parsed to bin_region_column! Needs to be county, state or country"
 
+        # The selected dates don't depend on the data type, so validate and
+        # select them once before any of the data is filtered
+        if specific_date == None:
+            value_columns = self._dates
+            date_positions = slice(None)
+        elif not specific_date == 'latest':
+            assert (specific_date in self._date_positions), "{} is not a valid date. Check the covid .csv files for what a valid dates look like!".format(specific_date)
+            value_columns = [specific_date]
+            position = self._date_positions[specific_date]
+            date_positions = slice(position, position + 1)
+        else:
+            latest_date = self._dates[-1]
+            value_columns = [latest_date]
+            date_positions = slice(-1, None)
+
+        # Each data type is a (locations dataframe, case counts array) pair
         data = {
-            'confirmed' : self.confirmed_df.copy(deep=True).fillna("none"),
-            'deaths'    : self.deaths_df.copy(deep=True).fillna("none")
+            'confirmed' : (self._confirmed_locations, self._confirmed_counts),
+            'deaths'    : (self._deaths_locations, self._deaths_counts)
         }
 
         if bin_region_column == 'country':
-            data['recovered'] = self.recovered_df.copy(deep=True).fillna("none")
+            data['recovered'] = (self._recovered_locations, self._recovered_counts)
 
         if not country == None:
+            confirmed_mask = self._categoryMask(self._confirmed_locations['Country/Region'], country)
             for data_type in data:
-                data[data_type] = data[data_type].loc[data[data_type]['Country/Region'] == country]
-
-        dates = data['confirmed'].columns[5:].to_list()
-        new_columns = ['Lat', 'Long'] + dates
-
-        # Order is required so Lat and Long are before dates
-        agg_dict = {}
-        agg_dict['Lat'] = ['mean']
-        agg_dict['Long'] = ['mean']
+                locations, counts = data[data_type]
+                if self._sharesConfirmedRows(data_type):
+                    country_mask = confirmed_mask
+                else:
+                    country_mask = self._categoryMask(locations['Country/Region'], country)
+                data[data_type] = (locations.iloc[country_mask], counts[country_mask])
+
+        # County specific dataset is just the full COVID dataset, so there is
+        # nothing to group
+        if bin_region_column == 'county':
+            for data_type in data:
+                locations, counts = data[data_type]
+                counts_df = pd.DataFrame(counts, index=locations.index, columns=self._dates)
+                data[data_type] = self._decategorize(pd.concat([locations, counts_df], axis=1))
+            return data, self.routesToWeightedEdges(bin_region_column, country)
 
-        if specific_date == None:
-            for date in dates: agg_dict[date] = ['sum']
-        elif not specific_date == 'latest':
-            assert (specific_date in dates), "{} is not a valid date. Check the covid .csv files for what a valid dates look like!".format(specific_date)
-            agg_dict[specific_date] = ['sum']
-            new_columns = ['Lat', 'Long'] + [specific_date]
+        if bin_region_column == 'state':
+            group_columns = ['Province/State', 'Country/Region']
         else:
-            latest_date = dates[-1]
-            agg_dict[latest_date] = ['sum']
-            new_columns = ['Lat', 'Long'] + [latest_date]
+            group_columns = ['Country/Region']
 
+        use_country_blocks = bin_region_column == 'country' and country == None
+        if not use_country_blocks:
+            confirmed_grouping = self._groupLocations(data['confirmed'][0], group_columns)
 
         for data_type in data:
-            df = data[data_type]
-            # County specific dataset is just the full COVID dataset
-            if bin_region_column == 'county': continue
-            if bin_region_column == 'state':
-                new_df = df.groupby(['Province/State', 'Country/Region']).agg(agg_dict)
-                new_df.columns = new_columns
-                new_df = new_df.reset_index()
-                data[data_type] = new_df
-            if bin_region_column == 'country':
-                new_df = df.groupby(['Country/Region']).agg(agg_dict)
-                new_df.columns = new_columns
-                new_df = new_df.reset_index()
-                data[data_type] = new_df
+            locations, counts = data[data_type]
+            if use_country_blocks:
+                # Each country is a contiguous block of the sorted counts
+                country_counts, group_starts, location_df = self._country_blocks[data_type]
+                sums = np.add.reduceat(country_counts[:, date_positions], group_starts, axis=0, dtype=np.int64)
+            else:
+                if self._sharesConfirmedRows(data_type):
+                    group_codes, location_df = confirmed_grouping
+                else:
+                    group_codes, location_df = self._groupLocations(locations, group_columns)
+                sums = self._sumGroups(group_codes, counts[:, date_positions], len(location_df))
+            sums_df = pd.DataFrame(sums, index=location_df.index, columns=value_columns)
+            # Order is required so Lat and Long are before dates
+            new_df = pd.concat([location_df, sums_df], axis=1)
+            data[data_type] = self._sortGroups(self._decategorize(new_df), group_columns)
 
         return data, self.routesToWeightedEdges(bin_region_column, country)
@@ -146,16 +146,18 @@ class CovidManager:
 
         # Only have data for confirmed and deaths for US so full dataset will
         # only have those features
-        full_dataset_dict = {'confirmed' : downloaded_df_dict['covid_confirmed'].copy(deep=True),
-                             'deaths'    : downloaded_df_dict['covid_deaths'].copy(deep=True)}
+        full_dataset_dict = {'confirmed' : downloaded_df_dict['covid_confirmed'],
+                             'deaths'    : downloaded_df_dict['covid_deaths']}
 
         # Drop the single US data entry since we have a full datset for it
         # Create a column the county from the US dataset
+        # Filtering and reindexing both return new dataframes, so the
+        # downloaded datasets don't need to be deep copied first
         for dataset_name in full_dataset_dict:
             df = full_dataset_dict[dataset_name]
 
-            df.insert(0, "County", [np.nan for ii in range(df.shape[0])], True)
             df = df.loc[df['Country/Region'] != 'US']
+            df = df.reindex(columns=['County'] + df.columns.to_list())
             full_dataset_dict[dataset_name] = df
 
 